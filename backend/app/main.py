@@ -1,24 +1,83 @@
 from fastapi import FastAPI, File, UploadFile, Depends, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse, FileResponse, ORJSONResponse
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, text, tuple_
 from typing import Optional
-from pydantic import BaseModel, constr
+from pydantic import BaseModel, ConfigDict, constr
+import aiofiles
 import asyncio
-import json
+import base64
+import logging
 import uuid
 import os
+import time
 from datetime import datetime
 
-from .database import get_db, engine, Base
-from .models import Product, Webhook, ImportJob
+from .database import get_db
+from .models import Product, Webhook, ImportJob, product_search_text
+from .progress import JobProgressListener
+from .schema import ensure_schema
+from .utils.count_cache import cached_product_count, invalidate_product_counts
+from .utils.serialization import json_bytes
 from app.tasks import process_csv_import
 
+logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Product Importer API", version="1.0.0")
-Base.metadata.create_all(bind=engine)
+PROGRESS_STREAM_SECONDS = 300
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 512 * 1024 * 1024))
+# Room for multipart boundaries and part headers on top of the file itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+UPLOAD_PATH = "/api/products/import"
+TERMINAL_JOB_STATUSES = ("completed", "completed_with_errors", "failed")
 
+
+app = FastAPI(title="Product Importer API", version="1.0.0", default_response_class=ORJSONResponse)
+ensure_schema()
+
+def _upload_too_large() -> HTTPException:
+    return HTTPException(413, f"File too large. Maximum upload size is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Caps the CSV upload request body before the form is parsed. Starlette spools
+    the whole multipart body to disk before the endpoint runs, so the endpoint's
+    own check alone still pays for the full transfer.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != UPLOAD_PATH:
+            await self.app(scope, receive, send)
+            return
+
+        limit = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > limit:
+            error = _upload_too_large()
+            response = ORJSONResponse({"detail": error.detail}, status_code=error.status_code)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            # Chunked bodies carry no Content-Length, so count as they arrive
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise _upload_too_large()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(UploadSizeLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -50,6 +109,42 @@ class WebhookUpdate(BaseModel):
     event_type: Optional[str] = None
     enabled: Optional[bool] = None
 
+class ProductOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    sku: str
+    name: str
+    description: Optional[str] = None
+    active: Optional[bool] = None
+    created_at: Optional[datetime] = None
+
+class ProductUpdated(ProductOut):
+    status: str = "success"
+
+class ProductPage(BaseModel):
+    products: list[ProductOut]
+    total: Optional[int] = None
+    page: Optional[int] = None
+    per_page: int
+    total_pages: Optional[int] = None
+    next_cursor: Optional[str] = None
+
+class WebhookOut(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    url: str
+    event_type: str
+    enabled: Optional[bool] = None
+    created_at: Optional[datetime] = None
+
+class WebhookUpdated(WebhookOut):
+    status: str = "success"
+
+class WebhookList(BaseModel):
+    webhooks: list[WebhookOut]
+
 @app.get("/")
 def serve_frontend():
     frontend_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "..", "frontend", "index.html")
@@ -61,7 +156,7 @@ def health_check():
 
 
 
-@app.post("/api/products/import")
+@app.post(UPLOAD_PATH)
 async def import_products(
     file: UploadFile = File(...),
     db: Session = Depends(get_db)
@@ -70,23 +165,30 @@ async def import_products(
     if not file.filename.endswith('.csv'):
         raise HTTPException(400, "Only CSV files are allowed")
     
-   
     job_id = str(uuid.uuid4())
-    job = ImportJob(id=job_id, status="pending")
-    db.add(job)
-    db.commit()
-    
-   
     upload_dir = "temp_uploads"
-    os.makedirs(upload_dir, exist_ok=True)
+    await asyncio.to_thread(os.makedirs, upload_dir, exist_ok=True)
     file_path = os.path.join(upload_dir, f"{job_id}.csv")
     
     
+    # UploadSizeLimitMiddleware bounds the whole body; this bounds the file exactly
     file_size = 0
-    with open(file_path, "wb") as f:
+    async with aiofiles.open(file_path, "wb") as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
         while chunk := await file.read(1024 * 1024): 
-            f.write(chunk)
             file_size += len(chunk)
+            if file_size > MAX_UPLOAD_BYTES:
+                break
+            await f.write(chunk)
+    
+    if file_size > MAX_UPLOAD_BYTES:
+        await asyncio.to_thread(os.remove, file_path)
+        raise _upload_too_large()
+    
+    job = ImportJob(id=job_id, status="pending")
+    db.add(job)
+    db.commit()
     
     file_size_mb = file_size / (1024 * 1024)
     
@@ -94,105 +196,155 @@ async def import_products(
     
     
     
-    from .tasks import process_csv_import_sync
-    import threading
-    thread = threading.Thread(target=process_csv_import_sync, args=(job_id, file_path))
-    thread.daemon = True
-    thread.start()
+    try:
+        # Publishing retries briefly when the broker is down; keep that off the event loop
+        await asyncio.to_thread(process_csv_import.delay, job_id, file_path)
+    except Exception as e:
+        # Imports never run in the web process; fail the job so its progress stream ends
+        logger.error(f"Could not queue import {job_id}: {e}")
+        job.status = "failed"
+        job.error_message = "The import queue is unavailable. Please upload the file again later."
+        job.completed_at = datetime.utcnow()
+        db.commit()
+        await asyncio.to_thread(os.remove, file_path)
+        raise HTTPException(503, "Import queue unavailable, please try again later")
    
     
     return {"job_id": job_id, "status": "processing", "file_size_mb": round(file_size_mb, 2)}
 
+def _sse(obj) -> bytes:
+    """Build a complete SSE data frame as bytes so Starlette can send it without re-encoding"""
+    return b"data: " + json_bytes(obj) + b"\n\n"
+
+def _job_progress(status: str, processed: int, total: int, error: Optional[str] = None) -> dict:
+    percent = int(processed / total * 100) if total > 0 else 0
+    return {
+        "status": status,
+        "processed": processed,
+        "total": total,
+        "percent": percent,
+        "error": error
+    }
+
 @app.get("/api/products/import/{job_id}/progress")
 async def import_progress(job_id: str, db: Session = Depends(get_db)):
     """SSE endpoint for real-time progress WITH ERROR DETAILS"""
     async def event_generator():
         try:
-            if not job_id or len(job_id) != 36:
-                yield f"data: {json.dumps({'status': 'invalid_id'})}\n\n"
-                return
-        except Exception:
-            yield f"data: {json.dumps({'status': 'invalid_id'})}\n\n"
+            uuid.UUID(job_id)
+        except ValueError:
+            yield _sse({'status': 'invalid_id'})
             return
         
-        for _ in range(600): 
-            db.expire_all()
+        deadline = time.monotonic() + PROGRESS_STREAM_SECONDS
+        async with JobProgressListener(job_id) as listener:
             job = db.query(ImportJob).filter(ImportJob.id == job_id).first()
             
             if not job:
-                yield f"data: {json.dumps({'status': 'not_found'})}\n\n"
-                break
-            
-            total = job.total_rows if job.total_rows > 0 else 1
-            percent = int((job.processed_rows / total * 100)) if total > 0 else 0
-            
-            progress = {
-                "status": job.status,
-                "processed": job.processed_rows,
-                "total": job.total_rows,
-                "percent": percent,
-                "error": job.error_message 
-            }
-            
-            yield f"data: {json.dumps(progress)}\n\n"
-            
-            if job.status in ["completed", "completed_with_errors", "failed"]:
-                break
+                yield _sse({'status': 'not_found'})
+                return
             
-            await asyncio.sleep(0.5)
+            progress = _job_progress(job.status, job.processed_rows, job.total_rows, job.error_message)
+            last_sent = None
+            last_write = time.monotonic()
+            while True:
+                if progress != last_sent:
+                    yield _sse(progress)
+                    last_sent = progress
+                    last_write = time.monotonic()
+                elif time.monotonic() - last_write >= listener.KEEPALIVE_INTERVAL:
+                    yield b": keepalive\n\n"
+                    last_write = time.monotonic()
+                
+                if progress["status"] in TERMINAL_JOB_STATUSES or time.monotonic() >= deadline:
+                    break
+                
+                update = await listener.wait()
+                if update and update["status"] not in TERMINAL_JOB_STATUSES:
+                    # NOTIFY payloads carry everything except the error text, which is only set at the end
+                    progress = _job_progress(update["status"], update["processed"], update["total"])
+                elif update or not listener.pushes:
+                    db.refresh(job, attribute_names=["status", "processed_rows", "total_rows", "error_message"])
+                    progress = _job_progress(job.status, job.processed_rows, job.total_rows, job.error_message)
     
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
-@app.get("/api/products")
+def _encode_cursor(product) -> str:
+    raw = f"{product.created_at.isoformat()}|{product.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, product_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(product_id)
+    except ValueError:
+        raise HTTPException(400, "Invalid cursor")
+
+@app.get("/api/products", response_model=ProductPage)
 def get_products(
-    page: int = Query(1, ge=1),
+    page: int = Query(1, ge=1, deprecated=True),
     per_page: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
     search: Optional[str] = None,
     active: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
-    """Get paginated products with filters"""
-    query = db.query(Product)
+    """
+    Get paginated products with filters.
+    Pass the returned next_cursor to fetch the following page; page numbers
+    still work but cost grows with depth because of OFFSET. total and
+    total_pages are only computed in page mode.
+    """
+    filters = []
     
     if search:
-        search_term = f"%{search}%"
-        query = query.filter(
-            (Product.sku.ilike(search_term)) |
-            (Product.name.ilike(search_term)) |
-            (Product.description.ilike(search_term))
-        )
+        filters.append(product_search_text.ilike(f"%{search}%"))
     
     if active and active != "all":
-        query = query.filter(Product.active == (active == "true"))
+        filters.append(Product.active == (active == "true"))
+    
+    # Plain rows rather than ORM instances; ProductOut reads them by attribute
+    query = db.query(
+        Product.id, Product.sku, Product.name, Product.description, Product.active, Product.created_at
+    ).filter(*filters).order_by(Product.created_at.desc(), Product.id.desc())
+    
+    if cursor:
+        # Cursor clients page with next_cursor, so skip the count entirely
+        total = None
+        last_created_at, last_id = _decode_cursor(cursor)
+        query = query.filter(tuple_(Product.created_at, Product.id) < (last_created_at, last_id))
+    else:
+        total = cached_product_count(
+            search, active,
+            lambda: db.query(func.count(Product.id)).filter(*filters).scalar()
+        )
+        query = query.offset((page - 1) * per_page)
     
-    total = query.count()
-    products = query.order_by(Product.created_at.desc()).offset((page - 1) * per_page).limit(per_page).all()
+    # Fetch one extra row to know whether another page follows
+    products = query.limit(per_page + 1).all()
+    has_more = len(products) > per_page
+    products = products[:per_page]
     
     return {
-        "products": [
-            {
-                "id": p.id,
-                "sku": p.sku,
-                "name": p.name,
-                "description": p.description,
-                "active": p.active,
-                "created_at": p.created_at.isoformat() if p.created_at else None
-            } for p in products
-        ],
+        "products": products,
         "total": total,
-        "page": page,
+        "page": None if cursor else page,
         "per_page": per_page,
-        "total_pages": (total + per_page - 1) // per_page if total > 0 else 0
+        "total_pages": None if total is None else (total + per_page - 1) // per_page,
+        "next_cursor": _encode_cursor(products[-1]) if has_more else None
     }
 
+def _sku_exists(db: Session, sku: str, exclude_id: Optional[int] = None) -> bool:
+    """Case-insensitive SKU check; lower(sku) matches the ix_products_sku_lower index"""
+    query = db.query(Product.id).filter(func.lower(Product.sku) == sku.strip().lower())
+    if exclude_id is not None:
+        query = query.filter(Product.id != exclude_id)
+    return query.first() is not None
+
 @app.post("/api/products")
 def create_product(product: ProductCreate, db: Session = Depends(get_db)):
     """Create new product manually"""
-    sku_lower = product.sku.strip().lower()
-    
-   
-    existing = db.query(Product).filter(func.lower(Product.sku) == sku_lower).first()
-    if existing:
+    if _sku_exists(db, product.sku):
         raise HTTPException(400, f"Product with SKU '{product.sku}' already exists")
     
     new_product = Product(
@@ -204,6 +356,7 @@ def create_product(product: ProductCreate, db: Session = Depends(get_db)):
     db.add(new_product)
     db.commit()
     db.refresh(new_product)
+    invalidate_product_counts()
     
    
     
@@ -214,23 +367,16 @@ def create_product(product: ProductCreate, db: Session = Depends(get_db)):
         "status": "success"
     }
 
-@app.get("/api/products/{product_id}")
+@app.get("/api/products/{product_id}", response_model=ProductOut)
 def get_product(product_id: int, db: Session = Depends(get_db)):
     """Get single product by ID"""
     product = db.query(Product).filter(Product.id == product_id).first()
     if not product:
         raise HTTPException(404, "Product not found")
     
-    return {
-        "id": product.id,
-        "sku": product.sku,
-        "name": product.name,
-        "description": product.description,
-        "active": product.active,
-        "created_at": product.created_at.isoformat() if product.created_at else None
-    }
+    return product
 
-@app.put("/api/products/{product_id}")
+@app.put("/api/products/{product_id}", response_model=ProductUpdated)
 def update_product(
     product_id: int,
     product_update: ProductUpdate,
@@ -243,12 +389,7 @@ def update_product(
     
     
     if product_update.sku and product_update.sku.strip().lower() != product.sku.lower():
-        sku_lower = product_update.sku.strip().lower()
-        existing = db.query(Product).filter(
-            func.lower(Product.sku) == sku_lower,
-            Product.id != product_id
-        ).first()
-        if existing:
+        if _sku_exists(db, product_update.sku, exclude_id=product_id):
             raise HTTPException(400, f"Product with SKU '{product_update.sku}' already exists")
     
    
@@ -263,9 +404,10 @@ def update_product(
     
     product.updated_at = datetime.utcnow()
     db.commit()
+    invalidate_product_counts()
     
-    
-    return {"status": "success", "id": product.id}
+    # Attributes were expired by the commit, so this returns the stored row
+    return product
 
 @app.delete("/api/products/{product_id}")
 def delete_product(product_id: int, db: Session = Depends(get_db)):
@@ -277,6 +419,7 @@ def delete_product(product_id: int, db: Session = Depends(get_db)):
     sku = product.sku
     db.delete(product)
     db.commit()
+    invalidate_product_counts()
     
 
     
@@ -285,9 +428,14 @@ def delete_product(product_id: int, db: Session = Depends(get_db)):
 @app.post("/api/products/bulk-delete")
 def bulk_delete_products(db: Session = Depends(get_db)):
     """Delete all products"""
-    count = db.query(Product).count()
-    db.query(Product).delete()
+    count = db.query(func.count(Product.id)).scalar()
+    if db.get_bind().dialect.name == "postgresql":
+        # Drops the table's files instead of deleting and WAL-logging each row
+        db.execute(text("TRUNCATE TABLE products RESTART IDENTITY"))
+    else:
+        db.query(Product).delete()
     db.commit()
+    invalidate_product_counts()
     
    
     
@@ -295,36 +443,22 @@ def bulk_delete_products(db: Session = Depends(get_db)):
 
 
 
-@app.get("/api/webhooks")
+@app.get("/api/webhooks", response_model=WebhookList)
 def get_webhooks(db: Session = Depends(get_db)):
     """Get all webhooks"""
-    webhooks = db.query(Webhook).all()
-    return {
-        "webhooks": [
-            {
-                "id": w.id,
-                "url": w.url,
-                "event_type": w.event_type,
-                "enabled": w.enabled,
-                "created_at": w.created_at.isoformat() if w.created_at else None
-            } for w in webhooks
-        ]
-    }
+    webhooks = db.query(
+        Webhook.id, Webhook.url, Webhook.event_type, Webhook.enabled, Webhook.created_at
+    ).all()
+    return {"webhooks": webhooks}
 
-@app.get("/api/webhooks/{webhook_id}")
+@app.get("/api/webhooks/{webhook_id}", response_model=WebhookOut)
 def get_webhook(webhook_id: int, db: Session = Depends(get_db)):
     """Get single webhook by ID"""
     webhook = db.query(Webhook).filter(Webhook.id == webhook_id).first()
     if not webhook:
         raise HTTPException(404, "Webhook not found")
     
-    return {
-        "id": webhook.id,
-        "url": webhook.url,
-        "event_type": webhook.event_type,
-        "enabled": webhook.enabled,
-        "created_at": webhook.created_at.isoformat() if webhook.created_at else None
-    }
+    return webhook
 
 @app.post("/api/webhooks")
 def create_webhook(webhook: WebhookCreate, db: Session = Depends(get_db)):
@@ -342,7 +476,7 @@ def create_webhook(webhook: WebhookCreate, db: Session = Depends(get_db)):
     
     return {"id": new_webhook.id, "status": "success"}
 
-@app.put("/api/webhooks/{webhook_id}")
+@app.put("/api/webhooks/{webhook_id}", response_model=WebhookUpdated)
 def update_webhook(
     webhook_id: int,
     webhook_update: WebhookUpdate,
@@ -364,7 +498,7 @@ def update_webhook(
     
 
     
-    return {"status": "success", "id": webhook.id}
+    return webhook
 
 @app.delete("/api/webhooks/{webhook_id}")
 def delete_webhook(webhook_id: int, db: Session = Depends(get_db)):
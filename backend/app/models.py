@@ -1,18 +1,39 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, func
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, Index, event, func, inspect, text
+from sqlalchemy.dialects.sqlite import DATETIME as SQLITE_DATETIME
 import uuid
 from .database import Base
 
+# SQLite's CURRENT_TIMESTAMP has no fractional seconds; bind values in the same
+# format so keyset comparisons on created_at line up with server defaults
+CreatedAt = DateTime(timezone=True).with_variant(
+    SQLITE_DATETIME(storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"),
+    "sqlite"
+)
+
 class Product(Base):
     __tablename__ = "products"
     
     id = Column(Integer, primary_key=True, index=True)
-    sku = Column(String(100), unique=True, index=True, nullable=False)
+    sku = Column(String(100), nullable=False)
     name = Column(String(255), nullable=False)
     description = Column(Text)
     active = Column(Boolean, default=True)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    created_at = Column(CreatedAt, server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
+    __table_args__ = (
+        # Case-insensitive SKU uniqueness and lookups; also the ON CONFLICT target
+        # for CSV upserts, so no separate case-sensitive index on sku is needed
+        Index("ix_products_sku_lower", func.lower(sku), unique=True),
+        # Keyset pagination order for the product list
+        Index("ix_products_created_at_id", created_at.desc(), id.desc()),
+    )
+
+# Text matched by product search; indexed with pg_trgm on PostgreSQL (see main.py)
+product_search_text = (
+    Product.sku + " " + Product.name + " " + func.coalesce(Product.description, "")
+)
+
 class Webhook(Base):
     __tablename__ = "webhooks"
     
@@ -32,4 +53,27 @@ class ImportJob(Base):
     processed_rows = Column(Integer, default=0)
     error_message = Column(Text)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    completed_at = Column(DateTime(timezone=True))
\ No newline at end of file
+    completed_at = Column(DateTime(timezone=True))
+
+
+def progress_channel(job_id: str) -> str:
+    return f"import_job_{job_id}"
+
+@event.listens_for(ImportJob, "after_update")
+def notify_import_progress(mapper, connection, job):
+    """
+    Publish job progress with pg_notify so SSE clients can LISTEN instead of polling.
+    NOTIFY is transactional: listeners only hear about it once the update commits.
+    """
+    if connection.dialect.name != "postgresql":
+        return
+
+    job_id = inspect(job).identity[0]
+    connection.execute(
+        text(
+            "SELECT pg_notify(:channel, json_build_object("
+            "'status', status, 'processed', processed_rows, 'total', total_rows)::text) "
+            "FROM import_jobs WHERE id = :job_id"
+        ),
+        {"channel": progress_channel(job_id), "job_id": job_id}
+    )
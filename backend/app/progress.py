@@ -0,0 +1,86 @@
+import asyncio
+import json
+import logging
+from typing import Optional
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from .database import engine
+from .models import progress_channel
+
+logger = logging.getLogger(__name__)
+
+
+class JobProgressListener:
+    """
+    Waits for ImportJob changes on behalf of the SSE progress stream.
+
+    On PostgreSQL this LISTENs on the job's channel (see notify_import_progress
+    in models.py) over a dedicated connection, so clients wake up only when the
+    worker commits progress. Other databases fall back to polling.
+    """
+
+    POLL_INTERVAL = 0.5
+    KEEPALIVE_INTERVAL = 15
+
+    def __init__(self, job_id: str):
+        self.channel = progress_channel(job_id)
+        self.notifications = asyncio.Queue()
+        self.conn = None
+
+    async def __aenter__(self):
+        if engine.dialect.name != "postgresql":
+            return self
+
+        url = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        try:
+            self.conn = await asyncio.to_thread(psycopg2.connect, url)
+            self.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with self.conn.cursor() as cur:
+                cur.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+        except psycopg2.Error as e:
+            # e.g. max_connections reached; polling still gets the client its progress
+            logger.warning(f"Progress LISTEN unavailable, falling back to polling: {e}")
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+            return self
+        asyncio.get_running_loop().add_reader(self.conn.fileno(), self._drain)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.conn is not None:
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            self.conn.close()
+
+    def _drain(self):
+        self.conn.poll()
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            self.notifications.put_nowait(json.loads(notify.payload))
+
+    @property
+    def pushes(self) -> bool:
+        """True when updates arrive as NOTIFY payloads rather than by polling"""
+        return self.conn is not None
+
+    async def wait(self) -> Optional[dict]:
+        """
+        Wait for the next change. Returns the latest NOTIFY payload (status,
+        processed, total), or None after a poll interval or keepalive timeout.
+        """
+        if self.conn is None:
+            await asyncio.sleep(self.POLL_INTERVAL)
+            return None
+
+        try:
+            payload = await asyncio.wait_for(self.notifications.get(), self.KEEPALIVE_INTERVAL)
+        except asyncio.TimeoutError:
+            return None
+
+        # Only the newest state matters when several updates queued up
+        while not self.notifications.empty():
+            payload = self.notifications.get_nowait()
+        return payload
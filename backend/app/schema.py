@@ -0,0 +1,110 @@
+"""
+Startup schema setup: tables, the indexes create_all can't add to existing
+tables, and the pg_trgm search index. Run `python -m app.schema --dedupe-skus`
+to clear case-variant duplicate SKUs left by older versions, which otherwise
+keep the unique ix_products_sku_lower index from being built.
+"""
+
+import argparse
+import logging
+
+from sqlalchemy import Index, delete, func, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateIndex
+
+from .database import Base, engine
+from .models import Product, product_search_text
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock key so concurrent gunicorn workers don't race on the DDL
+SCHEMA_LOCK_KEY = 727150001
+
+SEARCH_INDEX = Index(
+    "ix_products_search_trgm",
+    product_search_text.label("search_text"),
+    postgresql_using="gin",
+    postgresql_ops={"search_text": "gin_trgm_ops"}
+)
+
+
+def _existing_index_names(conn) -> set:
+    # Catalog lookup, since SQLite reflection skips expression indexes like lower(sku)
+    if conn.dialect.name == "postgresql":
+        query = "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()"
+    else:
+        query = "SELECT name FROM sqlite_master WHERE type = 'index'"
+    return set(conn.execute(text(query)).scalars())
+
+
+def _create_missing_indexes(conn) -> None:
+    existing = _existing_index_names(conn)
+    conn.commit()
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+                conn.commit()
+            except DBAPIError as e:
+                conn.rollback()
+                hint = " Run `python -m app.schema --dedupe-skus` to fix existing data." if index.unique else ""
+                logger.error(f"Could not create index {index.name}; continuing without it: {e}{hint}")
+
+    # Trigram GIN index so substring search on PostgreSQL is an index lookup, not a seq scan
+    if conn.dialect.name == "postgresql" and SEARCH_INDEX.name not in existing:
+        try:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(CreateIndex(SEARCH_INDEX, if_not_exists=True))
+            conn.commit()
+        except DBAPIError as e:
+            conn.rollback()
+            logger.warning(f"pg_trgm unavailable, product search will not use an index: {e}")
+
+
+def ensure_schema(bind=engine) -> None:
+    """
+    Create missing tables and indexes. On PostgreSQL an advisory lock lets one
+    worker do the DDL while the others wait, then find nothing left to create.
+    Index failures are logged rather than raised so the app still starts.
+    """
+    Base.metadata.create_all(bind=bind)
+
+    with bind.connect() as conn:
+        locked = conn.dialect.name == "postgresql"
+        if locked:
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+            conn.commit()
+        try:
+            _create_missing_indexes(conn)
+        finally:
+            if locked:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_KEY})
+                conn.commit()
+
+
+def dedupe_case_insensitive_skus(bind=engine) -> int:
+    """
+    Delete products whose SKU matches a newer product's ignoring case, keeping
+    the highest id (the last one written, as a CSV re-import would).
+    Returns the number of products removed.
+    """
+    newest = select(func.max(Product.id)).group_by(func.lower(Product.sku))
+    with bind.begin() as conn:
+        return conn.execute(delete(Product).where(Product.id.not_in(newest))).rowcount
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create missing tables and indexes")
+    parser.add_argument(
+        "--dedupe-skus", action="store_true",
+        help="first delete older products whose SKUs differ only by case"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.dedupe_skus:
+        removed = dedupe_case_insensitive_skus()
+        logger.info(f"Removed {removed} products with case-variant duplicate SKUs")
+    ensure_schema()
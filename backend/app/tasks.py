@@ -1,10 +1,16 @@
 from celery import Celery
-import pandas as pd
+import asyncio
+import csv
+import io
+import itertools
 import os
 from sqlalchemy import func
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from .database import SessionLocal
 from .models import Product, ImportJob, Webhook
+from .utils.count_cache import invalidate_product_counts
+from .utils.serialization import json_bytes
 import uuid, logging
 from datetime import datetime
 import httpx
@@ -24,7 +30,169 @@ celery_app.conf.update(
     enable_utc=True,
 )
 
-@celery_app.task
+# Minimum seconds between progress commits; each one also wakes SSE listeners
+PROGRESS_COMMIT_INTERVAL = 0.5
+
+# description is a Text column, so don't stop at the csv module's 128 KB field default
+CSV_FIELD_SIZE_LIMIT = 2**31 - 1
+
+# Webhook deliveries in flight at once; the rest wait their turn rather than time out in the pool
+WEBHOOK_CONCURRENCY = 50
+
+# Lowercased SKU/name values treated as missing (e.g. "NaN" exported by spreadsheets)
+_BAD = frozenset({'', 'nan', 'none'})
+
+# Column widths, checked per row so one long cell can't fail the whole merge
+SKU_MAX_LENGTH = Product.__table__.c.sku.type.length
+NAME_MAX_LENGTH = Product.__table__.c.name.type.length
+
+def upsert_products(db: Session, records: list) -> int:
+    """
+    Insert or update a batch of products in a single statement (SQLite path;
+    PostgreSQL imports go through StagedProductCopy instead).
+    Conflicts are resolved on lower(sku), so SKU matching stays case-insensitive.
+    Returns the number of newly created products.
+    """
+    sku_keys = [record["sku"].lower() for record in records]
+    existing = db.query(func.count(Product.id)).filter(
+        func.lower(Product.sku).in_(sku_keys)
+    ).scalar()
+
+    stmt = sqlite_insert(Product).values(records)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[func.lower(Product.sku)],
+        set_={
+            "name": stmt.excluded.name,
+            "description": stmt.excluded.description,
+            "updated_at": func.now()
+        }
+    )
+    db.execute(stmt)
+    return len(records) - existing
+
+class StagedProductCopy:
+    """
+    PostgreSQL bulk path for CSV imports: validated chunks are streamed with
+    COPY into a temp table, then merged into products with one statement.
+    Uses its own pooled connection so progress commits on the job session
+    don't end the staging transaction (the table is ON COMMIT DROP).
+    """
+
+    def __init__(self, bind):
+        self.conn = bind.raw_connection()
+        try:
+            self.cursor = self.conn.cursor()
+            self.cursor.execute(
+                "CREATE TEMP TABLE stg_products "
+                "(seq bigserial, sku text, name text, description text) ON COMMIT DROP"
+            )
+        except Exception:
+            # The caller never gets an object to close(), so hand the connection back here
+            self.conn.close()
+            raise
+
+    def copy(self, records) -> None:
+        buffer = io.StringIO()
+        # QUOTE_ALL keeps empty descriptions as '' rather than NULL
+        writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+        writer.writerows((r["sku"], r["name"], r["description"]) for r in records)
+        buffer.seek(0)
+        self.cursor.copy_expert(
+            "COPY stg_products (sku, name, description) FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+
+    def merge(self) -> int:
+        """
+        Upsert the staged rows (last occurrence of each SKU wins) and commit.
+        Returns the number of newly created products.
+        """
+        self.cursor.execute(
+            """
+            INSERT INTO products (sku, name, description, active)
+            SELECT sku, name, description, true FROM (
+                SELECT DISTINCT ON (lower(sku)) sku, name, description
+                FROM stg_products
+                ORDER BY lower(sku), seq DESC
+            ) latest
+            ON CONFLICT (lower(sku)) DO UPDATE SET
+                name = EXCLUDED.name,
+                description = EXCLUDED.description,
+                updated_at = now()
+            RETURNING (xmax = 0)
+            """
+        )
+        created = sum(1 for (inserted,) in self.cursor if inserted)
+        self.conn.commit()
+        return created
+
+    def close(self) -> None:
+        self.cursor.close()
+        # Returning the connection to the pool rolls back anything left open
+        self.conn.close()
+
+def _partial_import_note(committed_rows: int) -> str:
+    """Tell the user when rows before a fatal error were already saved"""
+    if not committed_rows:
+        return ""
+    return f"\n\n{committed_rows:,} products from earlier rows were already imported before this error."
+
+def count_csv_rows(file_path: str) -> int:
+    """Estimate the number of data rows by counting lines, without parsing the CSV"""
+    lines = 0
+    last_block = b"\n"
+    with open(file_path, "rb") as fh:
+        while block := fh.read(1024 * 1024):
+            lines += block.count(b"\n")
+            last_block = block
+    if not last_block.endswith(b"\n"):
+        lines += 1
+    return max(lines - 1, 0)
+
+def validate_rows(rows: list, first_row: int, sku_col: int, name_col: int, description_col=None) -> tuple:
+    """
+    Validate one chunk of raw CSV rows, with column positions resolved once from the header.
+    Returns (records keyed by lowercase SKU, number of valid rows, error messages).
+    Later rows with the same SKU win, as with the old row-by-row overwrite.
+    """
+    records = {}
+    errors = []
+    valid_rows = 0
+    width = max(sku_col, name_col, description_col or 0) + 1
+    
+    for row_number, row in enumerate(rows, first_row):
+        if len(row) < width:
+            row = row + [''] * (width - len(row))
+        
+        sku = row[sku_col].strip()
+        sku_lower = sku.lower()
+        if sku_lower in _BAD:
+            errors.append(f"Row {row_number}: Empty or invalid SKU")
+            continue
+        if len(sku) > SKU_MAX_LENGTH:
+            errors.append(f"Row {row_number}: SKU longer than {SKU_MAX_LENGTH} characters")
+            continue
+        
+        name = row[name_col].strip()
+        if name.lower() in _BAD:
+            errors.append(f"Row {row_number} (SKU: {sku}): Missing or invalid product name")
+            continue
+        if len(name) > NAME_MAX_LENGTH:
+            errors.append(f"Row {row_number} (SKU: {sku}): Product name longer than {NAME_MAX_LENGTH} characters")
+            continue
+        
+        records[sku_lower] = {
+            "sku": sku,
+            "name": name,
+            "description": row[description_col].strip() if description_col is not None else '',
+            "active": True
+        }
+        valid_rows += 1
+    
+    return records, valid_rows, errors
+
+# Progress and outcome are tracked on ImportJob, so there is no result to store
+@celery_app.task(ignore_result=True)
 def process_csv_import(job_id: str, file_path: str):
     """Process CSV import asynchronously"""
     process_csv_import_sync(job_id, file_path)
@@ -33,7 +201,8 @@ def process_csv_import_sync(job_id: str, file_path: str):
     """
     COMPLETE CSV PROCESSING WITH PERFECT ERROR HANDLING
     - Shows ALL error details to user
-    - Handles duplicate SKUs with UPSERT
+    - Handles duplicate SKUs with one bulk UPSERT per chunk, or on PostgreSQL
+      a COPY into a staging table merged in a single statement
     - Stops processing immediately on fatal errors
     - Updates progress even during failures
     - Returns detailed error messages
@@ -42,6 +211,10 @@ def process_csv_import_sync(job_id: str, file_path: str):
     
     db = SessionLocal()
     job = None
+    csv_file = None
+    stager = None
+    data_db = None
+    committed_rows = 0
     
     try:
        
@@ -67,8 +240,14 @@ def process_csv_import_sync(job_id: str, file_path: str):
         
       
         try:
-            df = pd.read_csv(file_path, encoding='utf-8')
-            total_rows = len(df)
+            total_rows = count_csv_rows(file_path)
+            csv.field_size_limit(CSV_FIELD_SIZE_LIMIT)
+            csv_file = open(file_path, newline='', encoding='utf-8-sig')
+            # filter(None, ...) drops blank lines, like DictReader/pandas did
+            reader = filter(None, csv.reader(csv_file))
+            header = next(reader, None)
+            if not header:
+                raise ValueError("No columns to parse from file")
         except UnicodeDecodeError:
             error_msg = "CSV encoding error. Please save your CSV as UTF-8 and try again."
             job.status = "failed"
@@ -86,13 +265,13 @@ def process_csv_import_sync(job_id: str, file_path: str):
         
        
         required_cols = ['sku', 'name']
-        missing_cols = [col for col in required_cols if col not in df.columns]
+        missing_cols = [col for col in required_cols if col not in header]
         
         if missing_cols:
             error_msg = (
                 f"❌ Missing required columns: {', '.join(missing_cols)}\n\n"
                 f"Required columns: sku, name\n"
-                f"Found columns: {', '.join(df.columns)}\n\n"
+                f"Found columns: {', '.join(header)}\n\n"
                 f"Please add the missing columns to your CSV and try again."
             )
           
@@ -110,106 +289,75 @@ def process_csv_import_sync(job_id: str, file_path: str):
         db.commit()
       
         chunk_size = 100
+        row_number = 1
         processed_count = 0
         created_count = 0
         updated_count = 0
         error_count = 0
         errors = []
+        last_progress_commit = time.monotonic()
         
       
-        for i in range(0, total_rows, chunk_size):
-            chunk = df.iloc[i:i + chunk_size]
-            chunk_num = i // chunk_size + 1
+        sku_col = header.index('sku')
+        name_col = header.index('name')
+        description_col = header.index('description') if 'description' in header else None
         
+        # Product writes get their own session/connection, so progress commits on
+        # the job session never share a transaction with a chunk being imported
+        if db.get_bind().dialect.name == "postgresql":
+            stager = StagedProductCopy(db.get_bind())
+        else:
+            data_db = SessionLocal()
+      
+        while chunk := list(itertools.islice(reader, chunk_size)):
+            first_row = row_number + 1
+            row_number += len(chunk)
+            records, valid_rows, chunk_errors = validate_rows(
+                chunk, first_row, sku_col, name_col, description_col
+            )
+            errors.extend(chunk_errors)
+            error_count += len(chunk_errors)
             
-            for idx, row in chunk.iterrows():
+            if records and stager:
+                stager.copy(records.values())
+                processed_count += valid_rows
+            elif records:
                 try:
-                  
-                    sku = str(row.get('sku', '')).strip()
-                    
-                 
-                    if not sku or sku.lower() in ['nan', 'none', '']:
-                        error_msg = f"Row {idx + 2}: Empty or invalid SKU"
-                        errors.append(error_msg)
-                        error_count += 1
-                       
-                        continue
-                    
-                  
-                    sku_lower = sku.lower()
-                    name = str(row.get('name', '')).strip()
-                    description = str(row.get('description', '')).strip() if pd.notna(row.get('description')) else ''
-                    
-                  
-                    if not name or name.lower() in ['nan', 'none', '']:
-                        error_msg = f"Row {idx + 2} (SKU: {sku}): Missing or invalid product name"
-                        errors.append(error_msg)
-                        error_count += 1
-                        continue
-                    
-                  
-                    existing_product = db.query(Product).filter(
-                        func.lower(Product.sku) == sku_lower
-                    ).first()
-                    
-                    if existing_product:
-                       
-                        existing_product.name = name
-                        existing_product.description = description
-                        existing_product.updated_at = datetime.utcnow()
-                        updated_count += 1
-                       
-                    else:
-                       
-                        new_product = Product(
-                            sku=sku,
-                            name=name,
-                            description=description,
-                            active=True
-                        )
-                        db.add(new_product)
-                        created_count += 1
-                      
-                    
-                    processed_count += 1
-                    
-                  
-                    if processed_count % 50 == 0:
-                        try:
-                            db.commit()
-                        except Exception as commit_err:
-                            db.rollback()
-                            error_msg = f"Database error at row {idx + 2}: {str(commit_err)}"
-                            errors.append(error_msg)
-                            error_count += 1
-                       
-                    
-                except Exception as row_error:
-                    error_msg = f"Row {idx + 2} (SKU: {row.get('sku', 'N/A')}): {str(row_error)}"
+                    created = upsert_products(data_db, list(records.values()))
+                    data_db.commit()
+                    committed_rows += valid_rows
+                    processed_count += valid_rows
+                    created_count += created
+                    updated_count += valid_rows - created
+                except Exception as commit_error:
+                    data_db.rollback()
+                    error_msg = f"Failed to import rows {first_row}-{row_number}: {str(commit_error)}"
                     errors.append(error_msg)
-                    error_count += 1
-                  
-                    continue
-            
-
-            try:
-                db.commit()
-              
-            except Exception as commit_error:
-                db.rollback()
-                error_msg = f"Failed to commit chunk at row {i}: {str(commit_error)}"
-                errors.append(error_msg)
-                error_count += chunk_size - processed_count
+                    error_count += valid_rows
              
             
            
-            job.processed_rows = min(i + chunk_size, total_rows)
-            db.commit()
-            
-          
-            progress_pct = int((job.processed_rows / total_rows) * 100)
+            if time.monotonic() - last_progress_commit >= PROGRESS_COMMIT_INTERVAL:
+                job.processed_rows = min(row_number - 1, total_rows)
+                db.commit()
+                last_progress_commit = time.monotonic()
           
         
+        if stager and processed_count:
+            try:
+                created_count = stager.merge()
+                committed_rows = processed_count
+                updated_count = processed_count - created_count
+            except Exception as merge_error:
+                errors.append(f"Failed to import staged rows: {str(merge_error)}")
+                error_count += processed_count
+                processed_count = 0
+        
+        # The line count is only an estimate (quoted newlines, blank lines)
+        total_rows = row_number - 1
+        job.total_rows = total_rows
+        job.processed_rows = total_rows
+        csv_file.close()
         
         try:
             db.commit()
@@ -287,6 +435,26 @@ def process_csv_import_sync(job_id: str, file_path: str):
 
         
       
+    except UnicodeDecodeError:
+        if job:
+            job.status = "failed"
+            job.error_message = (
+                "CSV encoding error. Please save your CSV as UTF-8 and try again."
+                + _partial_import_note(committed_rows)
+            )
+            job.completed_at = datetime.utcnow()
+            db.commit()
+
+    except csv.Error as e:
+        if job:
+            job.status = "failed"
+            job.error_message = (
+                f"Failed to parse CSV file: {str(e)}\n\nPlease check the file is a valid CSV."
+                + _partial_import_note(committed_rows)
+            )
+            job.completed_at = datetime.utcnow()
+            db.commit()
+
     except Exception as e:
       
         logger.exception("Fatal error while processing CSV import")
@@ -295,8 +463,9 @@ def process_csv_import_sync(job_id: str, file_path: str):
             if job:
                 job.status = "failed"
                 job.error_message = (
-                    f"❌ Fatal Error: {str(e)}\n\n"
-                    f"Full error details:\n{traceback.format_exc()}"
+                    f"❌ Fatal Error: {str(e)}"
+                    + _partial_import_note(committed_rows)
+                    + f"\n\nFull error details:\n{traceback.format_exc()}"
                 )
                 job.completed_at = datetime.utcnow()
                 db.commit()
@@ -306,7 +475,16 @@ def process_csv_import_sync(job_id: str, file_path: str):
     
     finally:
       
+        if csv_file:
+            csv_file.close()
+        if stager:
+            stager.close()
+        if data_db:
+            data_db.close()
         db.close()
+        # Rows may have been committed even when the job failed part-way
+        if committed_rows:
+            invalidate_product_counts()
        
 
 @celery_app.task
@@ -314,37 +492,48 @@ def trigger_webhooks(event_type: str, payload: dict):
     trigger_webhooks_sync(event_type, payload)
 
 def trigger_webhooks_sync(event_type: str, payload: dict):
+    asyncio.run(trigger_webhooks_async(event_type, payload))
+
+async def trigger_webhooks_async(event_type: str, payload: dict):
+    """Post one event to every enabled webhook in parallel over a shared connection pool"""
     db = SessionLocal()
     
     try:
-        webhooks = db.query(Webhook).filter(
+        urls = [url for (url,) in db.query(Webhook.url).filter(
             Webhook.event_type == event_type,
             Webhook.enabled == True
-        ).all()
+        ).all()]
         
-        if not webhooks:
+        if not urls:
             return
         
+        body = json_bytes({
+            "event": event_type,
+            "data": payload,
+            "timestamp": datetime.utcnow().isoformat()
+        })
         
-        for webhook in webhooks:
-            try:
-                webhook_payload = {
-                    "event": event_type,
-                    "data": payload,
-                    "timestamp": datetime.utcnow().isoformat()
-                }
-                
-                with httpx.Client() as client:
-                    response = client.post(
-                        webhook.url,
-                        json=webhook_payload,
-                        timeout=10.0
-                    )
-            except Exception as e:
-               logger.error(f"Webhook failed: {webhook.url} - Error: {e}")
+        semaphore = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+        
+        async def post(url: str):
+            async with semaphore:
+                return await client.post(url, content=body, headers={"content-type": "application/json"})
+        
+        async with httpx.AsyncClient(
+            timeout=10.0,
+            limits=httpx.Limits(
+                max_connections=WEBHOOK_CONCURRENCY,
+                max_keepalive_connections=WEBHOOK_CONCURRENCY
+            )
+        ) as client:
+            results = await asyncio.gather(*(post(url) for url in urls), return_exceptions=True)
+        
+        for url, result in zip(urls, results):
+            if isinstance(result, Exception):
+               logger.error(f"Webhook failed: {url} - Error: {result}")
 
     
     except Exception as e:
         logger.error(f"Error in webhook processing: {e}")
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
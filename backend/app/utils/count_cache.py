@@ -0,0 +1,63 @@
+import hashlib
+import logging
+import os
+from typing import Callable, Optional
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+# Seconds a product count stays cached; 0 disables the cache
+COUNT_CACHE_TTL = int(os.getenv("COUNT_CACHE_TTL", "30"))
+COUNT_KEY_PREFIX = "products:count:"
+# Bumped on every product write; counts cached under an older generation are never read again and expire by TTL
+COUNT_GENERATION_KEY = f"{COUNT_KEY_PREFIX}generation"
+
+_redis = redis.Redis.from_url(
+    os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+    socket_connect_timeout=0.2,
+    socket_timeout=0.2
+)
+
+
+def _count_key(search: Optional[str], active: Optional[str]) -> str:
+    generation = _redis.get(COUNT_GENERATION_KEY) or b"0"
+    # Hash the search text so arbitrary user input can't make arbitrarily long keys
+    search_hash = hashlib.blake2b((search or "").encode(), digest_size=16).hexdigest()
+    return f"{COUNT_KEY_PREFIX}{int(generation)}:{active or ''}:{search_hash}"
+
+
+def cached_product_count(search: Optional[str], active: Optional[str], compute: Callable[[], int]) -> int:
+    """
+    Return the product count for a listing filter, calling compute() on a miss.
+    Falls back to compute() whenever Redis is unavailable.
+    """
+    if COUNT_CACHE_TTL <= 0:
+        return compute()
+
+    try:
+        key = _count_key(search, active)
+        cached = _redis.get(key)
+    except redis.RedisError as e:
+        logger.debug(f"Count cache unavailable: {e}")
+        return compute()
+    if cached is not None:
+        return int(cached)
+
+    count = compute()
+    try:
+        _redis.setex(key, COUNT_CACHE_TTL, count)
+    except redis.RedisError as e:
+        logger.debug(f"Could not cache product count: {e}")
+    return count
+
+
+def invalidate_product_counts() -> None:
+    """Retire every cached product count; call after products are added, changed or removed"""
+    if COUNT_CACHE_TTL <= 0:
+        return
+
+    try:
+        _redis.incr(COUNT_GENERATION_KEY)
+    except redis.RedisError as e:
+        logger.warning(f"Could not invalidate product counts: {e}")
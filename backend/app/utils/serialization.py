@@ -0,0 +1,6 @@
+import orjson
+
+
+def json_bytes(obj) -> bytes:
+    """Serialize obj to UTF-8 encoded JSON with orjson"""
+    return orjson.dumps(obj)
@@ -0,0 +1,158 @@
+"""
+Shared test wiring: an in-memory database joined to a per-test transaction,
+the get_db override and the TestClient
+"""
+
+import io
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+# Counts must reflect each test's fresh tables, so bypass the Redis count cache
+os.environ.setdefault("COUNT_CACHE_TTL", "0")
+
+from app import tasks
+from app.main import app
+from app.database import Base, get_db
+from app.models import Product, Webhook
+
+
+# CSV uploads, encoded once; the fixtures below wrap them in a fresh BytesIO per test
+SAMPLE_CSV_BYTES = (
+    b"sku,name,description\n"
+    b"PROD-001,Product 1,Description 1\n"
+    b"PROD-002,Product 2,Description 2\n"
+    b"PROD-003,Product 3,Description 3\n"
+)
+DUPLICATE_SKU_CSV_BYTES = (
+    b"sku,name,description\n"
+    b"DUP-001,First,Description 1\n"
+    b"DUP-001,Second,Description 2\n"
+)
+MISSING_NAME_CSV_BYTES = (
+    b"sku,description\n"
+    b"PROD-001,No name column\n"
+)
+IMPORT_CSV_BYTES = (
+    b"sku,name,description\n"
+    b"IMPORT-001,Imported Product 1,Description 1\n"
+    b"IMPORT-002,Imported Product 2,Description 2\n"
+)
+
+# One in-memory database shared by fixtures and the TestClient's worker thread
+SQLALCHEMY_DATABASE_URL = "sqlite://"
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool
+)
+# Sessions join each test's outer transaction; app commits only release a SAVEPOINT
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, join_transaction_mode="create_savepoint")
+
+
+@event.listens_for(engine, "connect")
+def configure_sqlite(dbapi_connection, connection_record):
+    # pysqlite's own transaction handling breaks SAVEPOINT; let SQLAlchemy emit BEGIN
+    dbapi_connection.isolation_level = None
+    # Test data is throwaway, so skip durability work (matters if the URL points at a file)
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.execute("PRAGMA journal_mode=MEMORY")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+@event.listens_for(engine, "begin")
+def emit_begin(conn):
+    conn.exec_driver_sql("BEGIN")
+
+
+@pytest.fixture(scope="session")
+def client():
+    """One TestClient (and lifespan) for the whole run"""
+    with TestClient(app) as test_client:
+        yield test_client
+
+@pytest.fixture(scope="session")
+def connection():
+    """
+    Create the schema once per run. Each xdist worker has its own in-memory
+    database, so workers never share or wait on each other's schema.
+    """
+    with engine.connect() as conn:
+        Base.metadata.create_all(bind=conn)
+        conn.commit()
+        yield conn
+        Base.metadata.drop_all(bind=conn)
+        conn.commit()
+
+@pytest.fixture(autouse=True)
+def db(connection):
+    """
+    Session shared by the test and the API (via get_db), inside a transaction
+    that is rolled back afterwards
+    """
+    transaction = connection.begin()
+    TestingSessionLocal.configure(bind=connection)
+    session = TestingSessionLocal()
+    app.dependency_overrides[get_db] = lambda: session
+    yield session
+    session.close()
+    transaction.rollback()
+
+@pytest.fixture
+def sample_product(db):
+    """Create a sample product for testing"""
+    product = Product(
+        sku="TEST-001",
+        name="Test Product",
+        description="Test Description",
+        active=True
+    )
+    db.add(product)
+    db.flush()
+    return product
+
+@pytest.fixture
+def sample_webhook(db):
+    """Create a sample webhook for testing"""
+    webhook = Webhook(
+        url="https://webhook.site/test",
+        event_type="product.imported",
+        enabled=True
+    )
+    db.add(webhook)
+    db.flush()
+    return webhook
+
+@pytest.fixture
+def sample_csv():
+    """Three valid products"""
+    return io.BytesIO(SAMPLE_CSV_BYTES)
+
+@pytest.fixture
+def duplicate_sku_csv():
+    """Two rows sharing one SKU"""
+    return io.BytesIO(DUPLICATE_SKU_CSV_BYTES)
+
+@pytest.fixture
+def missing_name_csv():
+    """CSV without the required name column"""
+    return io.BytesIO(MISSING_NAME_CSV_BYTES)
+
+@pytest.fixture
+def import_csv():
+    """Two products for the import-to-list workflow"""
+    return io.BytesIO(IMPORT_CSV_BYTES)
+
+@pytest.fixture(autouse=True)
+def run_imports(monkeypatch):
+    """
+    Run Celery tasks eagerly against the test database, so uploads never
+    publish to a real broker
+    """
+    monkeypatch.setattr(tasks, "SessionLocal", TestingSessionLocal)
+    monkeypatch.setattr(tasks.celery_app.conf, "task_always_eager", True)